@@ -16,23 +16,39 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import atexit
+import collections
 import datetime
-import matplotlib.axes
+import math
 import requests
+from requests.adapters import HTTPAdapter
 import time
-import matplotlib.pyplot as plt
-import matplotlib
-import pandas as pd
+import numpy as np
+import orjson
 import os
 from pathlib import Path
 import dotenv
 import logging
-import psutil
 import coloredlogs
 import gzip
+import heapq
+import select
+import shutil
+import signal
+import socket
+import queue
+import threading
+from urllib3.util.retry import Retry
 from pydantic import Field, field_validator
 from pydantic_settings import BaseSettings
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
 dotenv.load_dotenv()
 
 
@@ -40,11 +56,13 @@ class Config(BaseSettings):
     LOGLEVEL: str = Field(default="INFO")
     API_KEY: str = Field()
     REQTIME: int = Field(default=60)
+    # Polling backs off up to this interval while kudos aren't changing
+    MAXREQTIME: int = Field(default=15 * 60)
     SHOWMA: bool = Field(default=True)
     SHOWD1: bool = Field(default=True)
     SHOWMAD1: bool = Field(default=True)
     NUMBACKUPS: int = Field(default=10)
-    # Default to averaging over 2 days (24 hours * 60 minutes * 2 days) for a REQTIME of 60s
+    # Number of samples averaged. Defaults to 2 days (24 hours * 60 minutes * 2 days) when polling every 60s; backed off polls stretch it.
     MAWINDOW: int = Field(default=24 * 60 * 2)
 
     @field_validator("LOGLEVEL")
@@ -91,7 +109,7 @@ except Exception as e:
     err_logger = logging.getLogger(__name__)
     coloredlogs.install(level="INFO", logger=err_logger)
     err_logger.error(e)
-    # It's okay to just exit at this point instead of doexit. The lockfile has neither been checked or deleted. We should probably preserve it rather than trying too hard to check it.
+    # It's okay to just exit at this point instead of doexit. The lockfile hasn't been locked yet.
     exit()
 # Setup logging
 logger = logging.getLogger(__name__)
@@ -104,54 +122,146 @@ BACKUP_DIR = Path.cwd() / "bak.d"
 OUTPUT_FILE = Path.cwd() / "out.csv"
 ENV_FILE = Path.cwd() / ".env"
 OUT_IMAGE_FILE = Path.cwd() / "out.png"
+# 800x450 pixels for the 10x5.625 inch figure
+OUT_IMAGE_DPI = 80
+# Binary copy of the history, plus the size out.csv had when it was written
+HISTORY_FILE = Path.cwd() / "out.npy"
+HISTORY_META_FILE = Path.cwd() / "out.npy.meta"
+
+FIND_USER_URL = "https://aihorde.net/api/v2/find_user"
+# Seconds to wait for the connection and for the response
+REQUEST_TIMEOUT = (5, 10)
+
+# Share one keep-alive connection between requests instead of doing a new TCP and TLS handshake every tick.
+SESSION = requests.Session()
+SESSION.headers.update({"apikey": config.API_KEY, "User-Agent": "KudoMan"})
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=1,
+        # 429 and 503 carry Retry-After, which the main loop honours instead of retrying or blocking inside the request.
+        max_retries=Retry(
+            total=3,
+            backoff_factor=1,
+            status_forcelist=[502, 504],
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        ),
+    ),
+)
+
+# Linux ioctl that clones a file's extents into another file, on filesystems such as btrfs and XFS.
+FICLONE = 0x40049409
+
+CSV_COLUMNS = ["Time", "Kudos", "MA", "D1", "MAD1"]
+# Formats one CSV row; log_kudos and the savetxt format in load_output_file must agree.
+format_row = "{:.2f},{:d},{:.4f},{:.4f},{:.4f}\n".format
+# Number of samples the first difference is averaged over.
+MAD1WINDOW = 15
+# Rows buffered in memory before out.csv is flushed.
+FLUSH_EVERY = 10
+# Seconds after which buffered rows are flushed anyway, so a backed off poll interval can't keep hours of rows out of the file.
+FLUSH_INTERVAL = config.REQTIME * FLUSH_EVERY
+# Rows kept in out.csv. Once it grows a tenth past this, older rows are archived to the backup directory so loading and plotting stay bounded.
+MAX_ROWS = max(config.MAWINDOW * 2, 100000)
+
+# Rolling state for the derived columns. It is seeded from the output file on startup so each tick only has to compute the newest row instead of rewriting the whole file.
+_stats = {
+    "ma_sum": 0.0,
+    "ma_deque": collections.deque(maxlen=config.MAWINDOW),
+    "prev_kudos": None,
+    "prev_time": None,
+    "d1_sum": 0.0,
+    "d1_deque": collections.deque(maxlen=MAD1WINDOW),
+}
+
+# Open handle of LOCKFILE. Holding it keeps the lock.
+_lock = {"file": None}
+
+# Seconds between backups of out.csv while running.
+BACKUP_INTERVAL = 60 * 60
+
+# Plot requests for the worker thread. One pending request is enough, since every plot draws the whole history.
+PLOT_QUEUE = queue.Queue(maxsize=1)
+
+# Append handle for out.csv, kept open for the whole run so each tick is a buffered write rather than an open and close.
+_output = {"file": None, "unflushed": 0, "flushed_at": 0.0}
+
+# Every logged row as float64, in CSV column order, so plotting never has to parse out.csv. Grown by doubling.
+# The generation changes whenever rows are dropped or replaced rather than appended.
+_history = {"data": np.empty((1024, len(CSV_COLUMNS))), "count": 0, "generation": 0}
+
+# Most points drawn per line. About two per horizontal pixel of the saved image; longer histories are downsampled.
+PLOT_POINTS = 1600
+
+# Fraction of the data range added above the autoscaled limits when they have to grow. Until the data outgrows them, plots only redraw the lines.
+PLOT_HEADROOM = 0.1
+
+# Set by the signal handler to end the main loop. The handler only sets the flag; the socket pair is written by Python's C-level handler through signal.set_wakeup_fd and wakes up wait_for_stop.
+_stop = {"requested": False, "wakeup": None}
+
+# ETag of the last find_user response and the kudos it held, for conditional requests.
+_last_response = {"etag": None, "kudos": None}
+
+# Figure, axes and line handles. Created on the first plot and updated in place afterwards.
+_plot_state = {}
 
 
 def doexit(code=1):
-    """Remove the lockfile and exit the program."""
-    LOCKFILE.unlink(missing_ok=True)
+    """Release the lockfile and exit the program."""
+    # Write out buffered rows and the history snapshot while the lock is still held, so they can't land after another instance's.
+    if _output["file"] is not None:
+        try:
+            save_history_file()
+        except OSError as e:
+            # The next start parses out.csv instead
+            logger.error(f"Couldn't save the history: {e}")
+    close_output_file()
+    if _lock["file"] is not None:
+        # Closing the handle drops the lock. The file itself is left in place so a starting instance can never lock a file that is about to be unlinked.
+        _lock["file"].close()
+        _lock["file"] = None
+    SESSION.close()
     exit(code)
 
 
-def is_lockfile_stale():
-    """Check if the system probably didn't delete the lockfile."""
-    with open(LOCKFILE, "r") as f:
-        llock = f.read().split(",")
-        lstart = float(llock[1])
-        lpid = int(llock[0])
-
-    # If we've rebooted since the lockfile was created, it's probably a stale lockfile.
-    rebooted = psutil.boot_time() < (time.time() - lstart)
-    if rebooted:
-        return True
-    try:
-        lproc = psutil.Process(lpid)
-        if lproc.is_running():
-            # if it's running in a different directory than the current one, it's probably not this program. This isn't perfect, but it might help.
-            return not (Path.cwd()).resolve().samefile(lproc.cwd())
-    except psutil.NoSuchProcess:
-        return True
-    return False
+def lock_file(f):
+    """Take an exclusive, non-blocking OS lock on an open file. Raises OSError if it is already held."""
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
 
 
 def setup_lockfile():
-    """Setup the lockfile and handle stale lockfiles."""
-    if LOCKFILE.exists():
-        if is_lockfile_stale():
-            LOCKFILE.unlink()
-        else:
-            logger.error(
-                f"Another instance of KudoMan is probably running! Please stop the other instance to start a new one. If you are sure there is not, you may remove {LOCKFILE}"
-            )
-            with open(LOCKFILE, "rt") as f:
-                values = f.read().split(",")
+    """Lock the lockfile for the lifetime of the process, exiting if another instance holds it."""
+    f = open(LOCKFILE, "a+")
+    try:
+        lock_file(f)
+    except OSError:
+        logger.error(
+            "Another instance of KudoMan is running! Please stop the other instance to start a new one."
+        )
+        try:
+            f.seek(0)
+            values = f.read().split(",")
             logger.info(
                 f"KudoMan is running on PID {values[0]}, started at {datetime.datetime.fromtimestamp(float(values[1])).isoformat()}"
             )
-            doexit()
-    pid = os.getpid()
-    start_time = time.time()
-    with open(LOCKFILE, "wt") as f:
-        f.write(f"{pid},{start_time}")
+        except (OSError, ValueError, IndexError):
+            # Windows won't let us read the locked byte, and an old instance may not have finished writing
+            pass
+        f.close()
+        # The lock isn't ours yet, so doexit has nothing to release. A distinct code lets scripts tell this apart from a failure.
+        doexit(2)
+    # The OS releases the lock when the process exits, so a crash can't leave a stale lock behind.
+    _lock["file"] = f
+    f.seek(0)
+    f.truncate()
+    f.write(f"{os.getpid()},{time.time()}")
+    f.flush()
 
 
 def setup_backup_dir():
@@ -159,36 +269,90 @@ def setup_backup_dir():
     if not BACKUP_DIR.exists():
         logger.info("No backup folder, creating bak.d")
         BACKUP_DIR.mkdir()
-    backups = sorted(
-        BACKUP_DIR.iterdir(), key=lambda x: x.stat().st_ctime, reverse=True
-    )
+    prune_backups()
+
+
+def prune_backups():
+    """Remove all but the NUMBACKUPS most recent backups."""
+    # Archived rows are kept; only the rotating backups are pruned.
+    with os.scandir(BACKUP_DIR) as it:
+        backups = [e for e in it if e.name.startswith("out-") and e.is_file()]
 
-    # Keep only the most recent backups
-    if len(backups) > config.NUMBACKUPS:
-        for old_backup in backups[config.NUMBACKUPS :]:
-            logger.info(f"Removing old backup: {old_backup}")
-            old_backup.unlink()
+    # Keep only the most recent backups. Names carry the creation time, so the oldest sort first without a stat per file.
+    excess = len(backups) - config.NUMBACKUPS
+    if excess > 0:
+        for old_backup in heapq.nsmallest(excess, backups, key=lambda e: e.name):
+            logger.info(f"Removing old backup: {old_backup.path}")
+            os.unlink(old_backup.path)
 
 
 def create_output_file():
-    """Create the output CSV file if it doesn't exist."""
+    """Create the output CSV file if it doesn't exist or is empty."""
     if not OUTPUT_FILE.exists():
         logger.info("No output file, creating out.csv")
-        with open(OUTPUT_FILE, "wt") as f:
-            f.write("Time,Kudos\n")
+    elif OUTPUT_FILE.stat().st_size == 0:
+        # e.g. left behind by a crash before the header was written. Appending rows to it would make the first row the header.
+        logger.info("Output file is empty, writing the header to out.csv")
+    else:
+        return
+    with open(OUTPUT_FILE, "wt") as f:
+        f.write(",".join(CSV_COLUMNS) + "\n")
+
+
+def repair_output_file():
+    """Drop a partial last row, e.g. from a crash part way through a buffered write, so parsing and later appends see whole rows."""
+    with OUTPUT_FILE.open("rb") as f:
+        header = f.readline()
+        size = f.seek(0, os.SEEK_END)
+        if size <= len(header):
+            return
+        # Only the end of the file is read; a row is far shorter than this.
+        start = f.seek(max(len(header), size - 4096))
+        tail = f.read()
+    complete = tail.endswith(b"\n")
+    body = tail[:-1] if complete else tail
+    last = body[body.rfind(b"\n") + 1 :]
+    if complete and last.count(b",") == header.count(b","):
+        return
+    cut = start + len(body) - len(last)
+    logger.warning(f"Dropping partial last row of out.csv: {last!r}")
+    os.truncate(OUTPUT_FILE, cut)
+
+
+def reflink(src, dst):
+    """Make dst a copy-on-write clone of src. Raises OSError where the filesystem or platform can't."""
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(src, "rb") as i, open(dst, "wb") as o:
+        fcntl.ioctl(o.fileno(), FICLONE, i.fileno())
 
 
 def backup_output_file():
     """Backup the current output CSV file."""
-    backup_file = BACKUP_DIR / f"out-{int(time.time())}.csv.gz"
-    with gzip.GzipFile(backup_file, "wb") as o, OUTPUT_FILE.open("rt") as i:
-        o.write(i.read().encode("utf-8"))
-
-
-def check_user(api_key):
-    response = requests.get(
-        "https://aihorde.net/api/v2/find_user", headers={"apikey": api_key}
-    )
+    stamp = int(time.time())
+    # A clone shares the data blocks with out.csv, so it's constant time and costs no space until out.csv changes.
+    # Backups are written under a temporary name and renamed into place, so a crash never leaves a truncated one behind.
+    clone_file = BACKUP_DIR / f"out-{stamp}.csv"
+    tmp_file = clone_file.with_suffix(".csv.tmp")
+    try:
+        reflink(OUTPUT_FILE, tmp_file)
+        os.replace(tmp_file, clone_file)
+        return
+    except OSError:
+        tmp_file.unlink(missing_ok=True)
+    backup_file = BACKUP_DIR / f"out-{stamp}.csv.gz"
+    tmp_file = backup_file.with_suffix(".gz.tmp")
+    # Stream the raw bytes; the fastest level is plenty for a numeric CSV. Leaving the time and name out of the gzip header makes backups of the same data byte for byte identical.
+    with OUTPUT_FILE.open("rb") as i, tmp_file.open("wb") as raw, gzip.GzipFile(
+        filename="", fileobj=raw, mode="wb", compresslevel=1, mtime=0
+    ) as o:
+        shutil.copyfileobj(i, o, length=1 << 20)
+    os.replace(tmp_file, backup_file)
+
+
+def check_user():
+    """Check that the API key belongs to a user and return the user's details."""
+    response = SESSION.get(FIND_USER_URL, timeout=REQUEST_TIMEOUT)
     if response.status_code == 404:
         logger.error(
             "User not found. Are you sure you entered the correct `API_KEY` into `.env`?"
@@ -196,74 +360,346 @@ def check_user(api_key):
         doexit()
 
     response.raise_for_status()
-    return True
+    return orjson.loads(response.content)
 
 
-def fetch_kudos(api_key):
+def retry_after(response):
+    """Return the seconds a 429 or 503 response asked us to wait, or None."""
+    if response is None or response.status_code not in (429, 503):
+        return None
+    # Only the delay-seconds form is supported, not an HTTP date.
+    try:
+        return max(0, int(response.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return None
+
+
+def fetch_kudos():
     """Fetch kudos from the API."""
-    response = requests.get(
-        "https://aihorde.net/api/v2/find_user", headers={"apikey": api_key}
-    )
+    headers = {}
+    if _last_response["etag"] is not None:
+        headers["If-None-Match"] = _last_response["etag"]
+    response = SESSION.get(FIND_USER_URL, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304:
+        # Not modified, so no body to download or parse
+        return _last_response["kudos"]
     response.raise_for_status()  # Ensure we handle HTTP errors
-    return response.json()["kudos"]
-
+    kudos = orjson.loads(response.content)["kudos"]
+    _last_response.update(etag=response.headers.get("ETag"), kudos=kudos)
+    return kudos
+
+
+def first_difference(kudos, prev_kudos, gap):
+    """Change in kudos per REQTIME, so samples further apart than REQTIME (e.g. while backed off) aren't overstated."""
+    if gap <= 0:
+        # The wall clock went backwards; the plain difference is the best we have
+        return float(kudos - prev_kudos)
+    return (kudos - prev_kudos) * config.REQTIME / gap
+
+
+def next_stats(kudos, timestamp):
+    """Return the MA, D1 and MAD1 of the next sample, without changing the rolling state."""
+    ma_deque = _stats["ma_deque"]
+    ma_sum, ma_count = _stats["ma_sum"] + kudos, len(ma_deque) + 1
+    if len(ma_deque) == ma_deque.maxlen:
+        ma_sum, ma_count = ma_sum - ma_deque[0], ma_count - 1
+    ma = ma_sum / ma_count
+
+    prev_kudos = _stats["prev_kudos"]
+    # The first sample has nothing to difference against.
+    if prev_kudos is None:
+        return ma, math.nan, math.nan
+    d1 = first_difference(kudos, prev_kudos, timestamp - _stats["prev_time"])
+    d1_deque = _stats["d1_deque"]
+    d1_sum, d1_count = _stats["d1_sum"] + d1, len(d1_deque) + 1
+    if len(d1_deque) == d1_deque.maxlen:
+        d1_sum, d1_count = d1_sum - d1_deque[0], d1_count - 1
+    return ma, d1, d1_sum / d1_count
+
+
+def update_stats(kudos, timestamp, d1):
+    """Push a logged sample and its D1 into the rolling state."""
+    ma_deque = _stats["ma_deque"]
+    if len(ma_deque) == ma_deque.maxlen:
+        _stats["ma_sum"] -= ma_deque[0]
+    ma_deque.append(kudos)
+    _stats["ma_sum"] += kudos
+
+    _stats["prev_kudos"] = kudos
+    _stats["prev_time"] = timestamp
+    if math.isnan(d1):
+        return
+    d1_deque = _stats["d1_deque"]
+    if len(d1_deque) == d1_deque.maxlen:
+        _stats["d1_sum"] -= d1_deque[0]
+    d1_deque.append(d1)
+    _stats["d1_sum"] += d1
+
+
+def rolling_mean(x, window):
+    """Trailing mean over up to `window` samples, computed from a cumulative sum."""
+    csum = np.empty(len(x) + 1)
+    csum[0] = 0
+    np.cumsum(x, out=csum[1:])
+    end = np.arange(1, len(x) + 1)
+    count = np.minimum(end, window)
+    return (csum[end] - csum[end - count]) / count
+
+
+def read_output_file():
+    """Parse the output file into an (N, 5) array, upgrading files that lack the derived columns."""
+    with OUTPUT_FILE.open("rt") as f:
+        columns = [c.strip() for c in f.readline().split(",")]
+        data_start = f.tell()
+        first_row = [c.strip() for c in f.readline().split(",")]
+        if first_row == [""]:
+            # No samples yet
+            return np.empty((0, len(CSV_COLUMNS)))
+        # Older files either have no derived columns or leave the first difference of the first row empty.
+        stale = columns != CSV_COLUMNS or len(first_row) != len(CSV_COLUMNS)
+        stale = stale or "" in first_row
+        f.seek(data_start)
+        if not stale:
+            # The stored derived columns are kept as written. Recomputing them would lose the history of rows already archived by a roll.
+            return np.loadtxt(f, delimiter=",", dtype=np.float64, ndmin=2)
+        # The derived columns are recomputed, so only time and kudos are parsed
+        arr = np.loadtxt(f, delimiter=",", usecols=(0, 1), dtype=np.float64, ndmin=2)
+    t = arr[:, 0]
+    kudos = arr[:, 1].astype(np.int64)
+    ma = rolling_mean(kudos, config.MAWINDOW)
+    # The first sample has nothing to difference against.
+    gap = np.diff(t)
+    d1 = np.diff(kudos).astype(np.float64)
+    # Per REQTIME, like first_difference
+    np.multiply(d1, config.REQTIME / gap, out=d1, where=gap > 0)
+    d1 = np.concatenate(([np.nan], d1))
+    mad1 = np.concatenate(([np.nan], rolling_mean(d1[1:], MAD1WINDOW)))
+    rows = np.column_stack((t, kudos, ma, d1, mad1))
+
+    logger.info("Adding derived columns to out.csv")
+    tmp_file = OUTPUT_FILE.with_suffix(".csv.tmp")
+    np.savetxt(
+        tmp_file,
+        rows,
+        fmt=["%.2f", "%d", "%.4f", "%.4f", "%.4f"],
+        delimiter=",",
+        header=",".join(CSV_COLUMNS),
+        comments="",
+    )
+    os.replace(tmp_file, OUTPUT_FILE)
+    return rows
 
-def log_kudos(kudos):
-    """Log kudos to the CSV file."""
-    with OUTPUT_FILE.open("at") as f:
-        timestamp = time.time()
-        f.write(f"{timestamp:.2f},{int(kudos)}\n")
-        logger.info(f"{int(kudos)} Kudos")
 
+def read_history_file():
+    """Load the history saved by the last run, or return None if it doesn't match the output file."""
+    try:
+        csv_size = int(HISTORY_META_FILE.read_text())
+        if csv_size != OUTPUT_FILE.stat().st_size:
+            return None
+        rows = np.load(HISTORY_FILE)
+    except (OSError, ValueError):
+        return None
+    if rows.ndim != 2 or rows.shape[1] != len(CSV_COLUMNS):
+        return None
+    return rows
+
+
+def save_history_file():
+    """Save the history next to the output file so the next start doesn't have to parse it."""
+    if _output["file"] is not None:
+        _output["file"].flush()
+    # Invalidate the old snapshot first, so a crash part way through can never leave a mismatched pair.
+    HISTORY_META_FILE.unlink(missing_ok=True)
+    tmp_file = HISTORY_FILE.with_suffix(".npy.tmp")
+    with tmp_file.open("wb") as f:
+        np.save(f, history_view())
+    os.replace(tmp_file, HISTORY_FILE)
+    HISTORY_META_FILE.write_text(str(OUTPUT_FILE.stat().st_size))
+
+
+def load_output_file():
+    """Load the history and seed the rolling stats from it."""
+    rows = read_history_file()
+    # The snapshot only stays valid until out.csv changes, so it's invalidated now and only a clean exit through doexit writes a new one.
+    HISTORY_META_FILE.unlink(missing_ok=True)
+    if rows is None:
+        rows = read_output_file()
+    _history["data"] = rows
+    _history["count"] = len(rows)
+    _history["generation"] += 1
+    if not len(rows):
+        return
+
+    ma_window = rows[-config.MAWINDOW :, 1].astype(np.int64).tolist()
+    _stats["ma_deque"].extend(ma_window)
+    _stats["ma_sum"] = float(sum(ma_window))
+    _stats["prev_kudos"] = int(rows[-1, 1])
+    _stats["prev_time"] = rows[-1, 0]
+    # Only the very first sample has no D1; after a roll, row 0 has one.
+    d1 = rows[-MAD1WINDOW - 1 :, 3]
+    d1_window = d1[~np.isnan(d1)][-MAD1WINDOW:].tolist()
+    _stats["d1_deque"].extend(d1_window)
+    _stats["d1_sum"] = float(sum(d1_window))
+
+
+def append_history(row):
+    """Append a row to the in-memory history, growing it when full."""
+    data, count = _history["data"], _history["count"]
+    if count == len(data):
+        grown = np.empty((max(2 * len(data), 1024), data.shape[1]))
+        grown[:count] = data
+        _history["data"] = data = grown
+    data[count] = row
+    _history["count"] = count + 1
+
+
+def history_view():
+    """Return the logged rows as an (N, 5) array view."""
+    # Read the count first: a buffer grown afterwards holds at least that many rows. A roll swaps in a shorter one, which callers detect through the generation.
+    count = _history["count"]
+    return _history["data"][:count]
+
+
+def open_output_file():
+    """Open the output file for appending."""
+    _output["file"] = OUTPUT_FILE.open("at", buffering=1 << 16)
+    _output["unflushed"] = 0
+    _output["flushed_at"] = time.monotonic()
+
+
+def close_output_file():
+    """Flush and close the output file, if it is open."""
+    if _output["file"] is not None:
+        try:
+            _output["file"].close()
+        finally:
+            _output["file"] = None
 
-def read_output_file_in_chunks(chunk_size=10000):
-    """Read the output file in chunks to handle large datasets efficiently."""
-    return pd.read_csv(OUTPUT_FILE, chunksize=chunk_size, skipinitialspace=True)
 
+def roll_output_file():
+    """Move all but the newest MAX_ROWS rows of the output file into a compressed archive."""
+    try:
+        close_output_file()
+        with OUTPUT_FILE.open("rt") as f:
+            header = f.readline()
+            lines = f.readlines()
+        # Name the archive after its first sample so consecutive archives never collide.
+        first_time = int(float(lines[0].split(",")[0]))
+        archive_file = BACKUP_DIR / f"archive-{first_time}.csv.gz"
+        logger.info(f"Archiving {len(lines) - MAX_ROWS} old rows to {archive_file}")
+        with gzip.open(archive_file, "wt", compresslevel=1) as o:
+            o.write(header)
+            o.writelines(lines[:-MAX_ROWS])
+        tmp_file = OUTPUT_FILE.with_suffix(".csv.tmp")
+        with tmp_file.open("wt") as o:
+            o.write(header)
+            o.writelines(lines[-MAX_ROWS:])
+        os.replace(tmp_file, OUTPUT_FILE)
+    finally:
+        # Logging has to carry on even if the roll failed; it is retried on the next tick.
+        open_output_file()
+    # The generation changes both before and after the swap, so a reader that sees the same generation on either side of history_view got a consistent view.
+    rows = history_view()[-MAX_ROWS:].copy()
+    _history["generation"] += 1
+    _history["data"] = rows
+    _history["count"] = MAX_ROWS
+    _history["generation"] += 1
 
-def update_secondary_stats():
-    """Update secondary stats efficiently by processing data in chunks."""
-    df_chunks = read_output_file_in_chunks()
-    results = []
-    for chunk in df_chunks:
-        chunk["MA"] = (
-            chunk["Kudos"].rolling(window=config.MAWINDOW, min_periods=0).mean()
-        )
-        chunk["D1"] = chunk["Kudos"].diff()
-        chunk["MAD1"] = chunk["D1"].rolling(window=15, min_periods=0).mean()
-        results.append(chunk)
-    final_df = pd.concat(results, ignore_index=True)
-    final_df.to_csv(OUTPUT_FILE, index=False)
 
+def log_kudos(kudos):
+    """Log kudos and its derived stats to the CSV file."""
+    kudos = int(kudos)
+    timestamp = time.time()
+    ma, d1, mad1 = next_stats(kudos, timestamp)
+    output = _output["file"]
+    output.write(format_row(timestamp, kudos, ma, d1, mad1))
+    # Only once the row is written, so a failed write can't leave the stats ahead of the file
+    update_stats(kudos, timestamp, d1)
+    unflushed = _output["unflushed"] + 1
+    now = time.monotonic()
+    if unflushed >= FLUSH_EVERY or now - _output["flushed_at"] >= FLUSH_INTERVAL:
+        output.flush()
+        unflushed = 0
+        _output["flushed_at"] = now
+    _output["unflushed"] = unflushed
+    logger.info("%d Kudos", kudos)
+    append_history((timestamp, kudos, ma, d1, mad1))
+    if _history["count"] > MAX_ROWS + MAX_ROWS // 10:
+        roll_output_file()
+
+
+def lttb(x, y, n_out):
+    """Pick n_out indices of (x, y) that keep the shape of the line, using Largest-Triangle-Three-Buckets."""
+    n = len(x)
+    if n <= n_out:
+        return np.arange(n)
+    # The first and last points are always kept, everything between is split into buckets that keep one point each.
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    sizes = np.diff(edges)
+    bucket = np.repeat(np.arange(len(sizes)), sizes)
+    inner = slice(1, n - 1)
+    mean_x = np.add.reduceat(x[inner], edges[:-1] - 1) / sizes
+    mean_y = np.add.reduceat(y[inner], edges[:-1] - 1) / sizes
+    # Each point is scored against the neighbouring buckets' averages instead of the point picked before it, so every bucket is scored at once.
+    prev_x = np.concatenate(([x[0]], mean_x[:-1]))[bucket]
+    prev_y = np.concatenate(([y[0]], mean_y[:-1]))[bucket]
+    next_x = np.concatenate((mean_x[1:], [x[-1]]))[bucket]
+    next_y = np.concatenate((mean_y[1:], [y[-1]]))[bucket]
+    area = np.abs(
+        (prev_x - next_x) * (y[inner] - prev_y)
+        - (prev_x - x[inner]) * (next_y - prev_y)
+    )
+    # Keep the largest triangle of each bucket. NaN areas (a NaN sample or neighbour) never win.
+    order = np.lexsort((np.nan_to_num(area, nan=-1.0), bucket))
+    picked = order[np.cumsum(sizes) - 1] + 1
+    return np.concatenate(([0], picked, [n - 1]))
+
+
+def widen_limits(ax, old):
+    """Keep the old view limits of ax while all of its data is still inside them, otherwise autoscale with headroom. Returns whether they changed."""
+    data = ax.dataLim.intervalx, ax.dataLim.intervaly
+    if old is not None and all(
+        o[0] <= d[0] and d[1] <= o[1] for o, d in zip(old, data)
+    ):
+        limits, changed = old, False
+    else:
+        # Room to grow into, so the next few ticks can reuse the background
+        ax.autoscale_view()
+        new = ax.get_xlim(), ax.get_ylim()
+        limits = [(n[0], n[1] + (n[1] - n[0]) * PLOT_HEADROOM) for n in new]
+        changed = True
+    # auto=None leaves autoscaling on for the next tick
+    ax.set_xlim(limits[0], auto=None)
+    ax.set_ylim(limits[1], auto=None)
+    _plot_state["limits"][ax] = ax.get_xlim(), ax.get_ylim()
+    return changed
+
+
+def setup_plot():
+    """Create the figure, axes and lines that plot_kudos updates."""
+    # matplotlib is only imported by the plot thread, the first time it plots, so it doesn't hold up startup.
+    import matplotlib
+
+    # Render straight to files; no GUI toolkit is needed.
+    matplotlib.use("Agg")
+    import matplotlib.axes
+    import matplotlib.image
+    import matplotlib.pyplot as plt
 
-def plot_kudos():
-    """Plot kudos over time."""
-    # Load dataframe
-    df = pd.read_csv(OUTPUT_FILE, skipinitialspace=True)
-    # Get time and Kudos
-    t = df["Time"]
-    ku = df["Kudos"]
-    ma = df["MA"]
-    d1 = df["D1"]
-    mad1 = df["MAD1"]
-    # Calculate the time as being relative to the first measurement
-    tn = t.to_numpy() - t.to_numpy()[0]
     # Make a figure
-    fig, kax = plt.subplots()
+    fig, kax = plt.subplots(dpi=OUT_IMAGE_DPI)
     fig.set_size_inches((10, 10 * 9 / 16))
     kax: matplotlib.axes.Axes = kax
-    # Plot the data
-    handles = [kax.plot(tn, ku, "b", label="Kudos")[0]]
+    # Make the (still empty) lines
+    lines = {"ku": kax.plot([], [], "b", label="Kudos")[0]}
     if config.SHOWMA:
-        handles.append(kax.plot(tn, ma, "r", label="Kudos (Moving Average)")[0])
+        lines["ma"] = kax.plot([], [], "r", label="Kudos (Moving Average)")[0]
 
     dkax = kax.twinx() if config.SHOWD1 or config.SHOWMAD1 else None
     if config.SHOWD1:
-        handles.append(dkax.plot(tn, d1, "g--", label="Kudos 1st difference")[0])
+        lines["d1"] = dkax.plot([], [], "g--", label="Kudos 1st difference")[0]
     if config.SHOWMAD1:
-        handles.append(
-            dkax.plot(tn, mad1, "y--", label="Kudo 1st difference (M.A.)")[0]
-        )
+        lines["mad1"] = dkax.plot([], [], "y--", label="Kudo 1st difference (M.A.)")[0]
 
     kax.set(
         xlabel="Time (Unix seconds)",
@@ -273,16 +709,169 @@ def plot_kudos():
     kax.set_ylabel("Kudos")
     if dkax is not None:
         dkax.tick_params(axis="y")
-        dkax.set_ylabel("\u0394Kudos/\u0394Time")
-
-    kax.legend(handles=handles)
-    fig.tight_layout()  # otherwise the right y-label is slightly clipped
+        dkax.set_ylabel(f"\u0394Kudos per {config.REQTIME}s")
 
+    legend = kax.legend(handles=list(lines.values()))
     # Turn on grid
     kax.grid()
-    # Save and close figure
-    fig.savefig(OUT_IMAGE_FILE)
-    plt.close(fig)
+    # The lines and the legend on top of them are drawn over a cached background, so they're left out of full draws.
+    for artist in (*lines.values(), legend):
+        artist.set_animated(True)
+    _plot_state.update(
+        fig=fig,
+        kax=kax,
+        dkax=dkax,
+        lines=lines,
+        legend=legend,
+        limits={},
+        imsave=matplotlib.image.imsave,
+    )
+
+
+def relative_times(t, start):
+    """Return t relative to the first measurement, converting only t[start:] and reusing the earlier values. Grown by doubling."""
+    times = _plot_state.get("times")
+    if times is None or len(times) < len(t):
+        grown = np.empty(max(2 * len(t), 1024))
+        if start:
+            grown[:start] = times[:start]
+        _plot_state["times"] = times = grown
+    np.subtract(t[start:], t[0], out=times[start : len(t)])
+    return times[: len(t)]
+
+
+def plot_kudos():
+    """Plot kudos over time."""
+    # Retry if a roll on the main thread replaced the history while taking the view
+    while True:
+        generation = _history["generation"]
+        rows = history_view()
+        if _history["generation"] == generation:
+            break
+    # Nothing new since the last save
+    plotted = (_plot_state.get("generation"), _plot_state.get("count"))
+    if plotted == (generation, len(rows)):
+        return
+    t, ku, ma, d1, mad1 = rows.T
+    # Only rows added since the last plot need converting and extending the data limits, unless the history was trimmed.
+    start = 0
+    if _plot_state.get("generation") == generation:
+        start = _plot_state["count"]
+    if start > len(rows):
+        # The history shrank without the generation changing in between, so nothing earlier can be reused.
+        start = 0
+    tn = relative_times(t, start)
+
+    first_plot = "fig" not in _plot_state
+    if first_plot:
+        setup_plot()
+    fig = _plot_state["fig"]
+    kax, dkax = _plot_state["kax"], _plot_state["dkax"]
+    # Update the data of the existing lines
+    columns = {"ku": ku, "ma": ma, "d1": d1, "mad1": mad1}
+    for name, line in _plot_state["lines"].items():
+        keep = lttb(tn, columns[name], PLOT_POINTS)
+        line.set_data(tn[keep], columns[name][keep])
+        if start:
+            line.axes.update_datalim(
+                np.column_stack((tn[start:], columns[name][start:]))
+            )
+    redraw = not start
+    for ax in (kax, dkax):
+        if ax is not None:
+            if not start:
+                ax.relim()
+            old = _plot_state["limits"].get(ax) if start else None
+            redraw = widen_limits(ax, old) or redraw
+    _plot_state.update(count=len(tn), generation=generation)
+    if first_plot:
+        fig.tight_layout()  # otherwise the right y-label is slightly clipped
+
+    canvas = fig.canvas
+    if redraw:
+        # Axes, ticks, labels and grid only need rendering again when the limits change.
+        canvas.draw()
+        _plot_state["background"] = canvas.copy_from_bbox(fig.bbox)
+    else:
+        canvas.restore_region(_plot_state["background"])
+    # Draw in the same order a full draw would: the twin axes' lines go over the legend.
+    for line in _plot_state["lines"].values():
+        if line.axes is kax:
+            kax.draw_artist(line)
+    kax.draw_artist(_plot_state["legend"])
+    for line in _plot_state["lines"].values():
+        if line.axes is dkax:
+            dkax.draw_artist(line)
+
+    # Save the rendered buffer, keeping the figure open for the next tick. It's renamed into place so viewers never see a partly written image.
+    tmp_file = OUT_IMAGE_FILE.with_suffix(".png.tmp")
+    _plot_state["imsave"](
+        tmp_file, np.asarray(canvas.buffer_rgba()), format="png", dpi=OUT_IMAGE_DPI
+    )
+    os.replace(tmp_file, OUT_IMAGE_FILE)
+
+
+def plot_worker():
+    """Render the plots requested through PLOT_QUEUE."""
+    while True:
+        PLOT_QUEUE.get()
+        try:
+            plot_kudos()
+        except Exception as e:
+            logger.error(f"Unexpected exception while plotting: {e}")
+
+
+def request_plot():
+    """Ask the plot worker for a new plot, unless one is already pending."""
+    try:
+        PLOT_QUEUE.put_nowait(None)
+    except queue.Full:
+        # Ticks that arrive during a slow plot are all served by the pending request.
+        pass
+
+
+def periodic_backup():
+    """Back up and prune, then schedule the next backup."""
+    try:
+        backup_output_file()
+        prune_backups()
+    except Exception as e:
+        logger.error(f"Unexpected exception while backing up: {e}")
+    schedule_backup()
+
+
+def schedule_backup():
+    """Run periodic_backup on a timer thread after BACKUP_INTERVAL seconds."""
+    timer = threading.Timer(BACKUP_INTERVAL, periodic_backup)
+    timer.daemon = True
+    timer.start()
+
+
+def request_stop(signum, frame):
+    """Signal handler that asks the main loop to finish, or interrupts the current tick on a repeated signal."""
+    # No locks (or logging) here: the handler runs on the main thread and could interrupt it while it holds one.
+    if _stop["requested"]:
+        # The tick is stuck, e.g. in a stalled request. Give up on finishing it, and let a third signal kill the process outright.
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        raise KeyboardInterrupt
+    _stop["requested"] = True
+
+
+def setup_stop_signals():
+    """Make SIGINT and SIGTERM request a stop, waking up wait_for_stop."""
+    receive, send = socket.socketpair()
+    # set_wakeup_fd needs a non-blocking fd, and a full socket must not block the handler either.
+    send.setblocking(False)
+    signal.set_wakeup_fd(send.fileno())
+    _stop["wakeup"] = (receive, send)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+
+def wait_for_stop(timeout):
+    """Sleep for up to timeout seconds, returning early when a stop signal arrives."""
+    select.select([_stop["wakeup"][0]], [], [], timeout)
 
 
 def enabled_disabled(s):
@@ -292,37 +881,73 @@ def enabled_disabled(s):
 def main():
     """Main function to run the script."""
     setup_lockfile()
-    check_user(config.API_KEY)
+    user = check_user()
 
     TIME = config.REQTIME
+    max_interval = max(config.MAXREQTIME, TIME)
     logger.info(f"Fetching every {TIME} seconds")
+    logger.info(f"Backing off to every {max_interval} seconds while kudos don't change")
     logger.info(f"Keeping {config.NUMBACKUPS} backups")
     logger.info(f"Moving average window of {config.MAWINDOW} samples")
     setup_backup_dir()
     create_output_file()
     backup_output_file()
+    repair_output_file()
+    load_output_file()
+    open_output_file()
+    atexit.register(close_output_file)
     logger.info("Moving average : " + enabled_disabled(config.SHOWMA))
     logger.info("First difference : " + enabled_disabled(config.SHOWD1))
     logger.info("M.a. F.d. : " + enabled_disabled(config.SHOWMAD1))
 
-    while True:
-        try:
-            kudos = fetch_kudos(config.API_KEY)
-            log_kudos(kudos)
-            update_secondary_stats()
-            plot_kudos()
-        except KeyboardInterrupt:
-            logger.info("Removing lockfile during processing, then exiting.")
-            doexit()
-        except requests.RequestException as e:
-            logger.warning(f"Exception caught: {e}")
-        except Exception as e:
-            logger.error(f"Unexpected exception: {e}")
-        try:
-            time.sleep(TIME)
-        except KeyboardInterrupt:
-            logger.info("Removing lockfile during delay, then exiting")
-            doexit()
+    # Plotting and backups run on their own threads so the fetch cadence doesn't depend on them.
+    threading.Thread(target=plot_worker, name="plot", daemon=True).start()
+    schedule_backup()
+    # Sleep until fixed deadlines so the time spent working doesn't add up into drift.
+    next_deadline = time.monotonic()
+    interval = TIME
+    last_kudos = None
+    # The user check already fetched the first sample, so the first tick doesn't need to.
+    kudos = user["kudos"]
+    # Ctrl+C and SIGTERM end the loop after the current tick instead of interrupting it part way through a write.
+    setup_stop_signals()
+    try:
+        while not _stop["requested"]:
+            wait = None
+            try:
+                if kudos is None:
+                    kudos = fetch_kudos()
+                log_kudos(kudos)
+                request_plot()
+                # Poll less often while kudos aren't changing, and go back to REQTIME as soon as they do.
+                if kudos == last_kudos:
+                    interval = min(interval * 2, max_interval)
+                else:
+                    interval = TIME
+                last_kudos = kudos
+            except requests.RequestException as e:
+                logger.warning(f"Exception caught: {e}")
+                wait = retry_after(e.response)
+            except Exception as e:
+                logger.error(f"Unexpected exception: {e}")
+            kudos = None
+            next_deadline += interval
+            if wait is not None:
+                logger.info(f"Server asked to wait {wait} seconds")
+                next_deadline = max(next_deadline, time.monotonic() + wait)
+            behind = time.monotonic() - next_deadline
+            if behind >= interval:
+                # e.g. after the machine was suspended. Skip the missed ticks instead of fetching them back to back.
+                logger.warning(
+                    f"Running {behind:.0f} seconds behind, skipping missed fetches"
+                )
+                next_deadline += behind // interval * interval
+            # Returns early when a stop is requested
+            wait_for_stop(max(0, next_deadline - time.monotonic()))
+    except KeyboardInterrupt:
+        logger.warning("Stopping part way through a tick")
+    logger.info("Releasing lockfile, then exiting.")
+    doexit()
 
 
 if __name__ == "__main__":